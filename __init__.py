@@ -1,114 +1,252 @@
+import hashlib
+import os
+import pickle
+import sys
+from typing import NamedTuple
+
 import binaryninja
-import math
-import svd2py
 from binaryninja import BinaryView, Type, StructureBuilder, Symbol, SymbolType, SegmentFlag, SectionSemantics, \
-    StructureType, StructureVariant, StructureMember, Settings
+    StructureMember, Settings
 
-BYTE_SIZE = 8
 
+class Field(NamedTuple):
+    name: str
+    lsb: int
+    msb: int
+
+
+class Register(NamedTuple):
+    name: str
+    description: str
+    address_offset: int
+    size: int
+    fields: tuple[Field, ...]
+
+
+class AddressBlock(NamedTuple):
+    offset: int
+    size: int
+
+
+class Peripheral(NamedTuple):
+    name: str
+    description: str
+    base_address: int
+    address_blocks: tuple[AddressBlock, ...]
+    registers: tuple[Register, ...]
+
+
+def convert_peripherals(device: dict) -> list[Peripheral]:
+    """Convert the svd2py device peripherals into records, so the importer does attribute access over dict lookups.
+
+    Names are interned as the same register and field names repeat across derived peripherals.
+    """
+    return [
+        Peripheral(
+            sys.intern(peripheral['name']),
+            peripheral['description'],
+            peripheral['baseAddress'],
+            tuple(AddressBlock(ablk['offset'], ablk['size']) for ablk in peripheral['addressBlock']),
+            tuple(
+                Register(
+                    sys.intern(register['name']),
+                    register['description'],
+                    register['addressOffset'],
+                    register['size'],
+                    tuple(Field(sys.intern(field['name']), field['lsb'], field['msb'])
+                          for field in register['fields']['field'])
+                )
+                for register in peripheral['registers']['register']
+            )
+        )
+        for peripheral in device['peripherals']['peripheral']
+    ]
+
+
+# Version of the cached peripheral records, bump whenever the records above change.
+CACHE_VERSION = 1
+
+
+def parse_device(file_path: str) -> tuple[str, list[Peripheral]]:
+    """Parse the SVD file into the device name and its peripherals.
+
+    The converted peripherals are cached in the user directory keyed by the SVD file hash, so importing the same SVD
+    again skips parsing entirely.
+    """
+    with open(file_path, 'rb') as svd_file:
+        digest = hashlib.sha256(svd_file.read()).hexdigest()
+    cache_dir = os.path.join(binaryninja.user_directory(), 'svdmap')
+    cache_path = os.path.join(cache_dir, f'{digest}.v{CACHE_VERSION}.pickle')
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                device_name, peripherals = pickle.load(cache_file)
+            binaryninja.log_info(f'using cached svd file... {cache_path}')
+            return device_name, peripherals
+        except Exception as e:
+            binaryninja.log_warn(f'failed to load cached svd file {cache_path}: {e}')
+
+    # Imported here so the plugin does not load svd2py and its parsers at startup, or at all on a cache hit.
+    import svd2py
 
-def import_svd(bv: BinaryView):
-    file_path = binaryninja.get_open_filename_input('SVD File')
-    if file_path is None: return
     binaryninja.log_info(f'parsing svd file... {file_path}')
     parser = svd2py.SvdParser()
     result = parser.convert(file_path)
     assert result['device'] is not None
     device = result['device']
     device_name: str = device['name']
-    binaryninja.log_info(f'parsing device... {device_name}')
-    peripherals = device['peripherals']['peripheral']
+    peripherals = convert_peripherals(device)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so a concurrent import never reads a partial cache file.
+        tmp_cache_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_cache_path, 'wb') as cache_file:
+            pickle.dump((device_name, peripherals), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_cache_path, cache_path)
+    except OSError as e:
+        binaryninja.log_warn(f'failed to cache svd file {cache_path}: {e}')
+    return device_name, peripherals
+
+
+# Unsigned integer types keyed by byte width, so we only go through the core once per width.
+_uint_types: dict[int, Type] = {}
+
+
+def uint_type(width: int) -> Type:
+    ty = _uint_types.get(width)
+    if ty is None:
+        ty = _uint_types[width] = Type.int(width, False)
+    return ty
+
+
+def field_is_byte_aligned(field_lsb: int, field_msb: int) -> bool:
+    return (field_lsb & 7) == 0 and ((field_msb + 1) & 7) == 0
 
-    show_comments = Settings().get_bool("SVDMapper.enableComments")
-    structure_bitfields = Settings().get_bool("SVDMapper.enableBitfieldStructuring")
 
-    for peripheral in peripherals:
-        per_name: str = peripheral['name']
-        per_desc: str = peripheral['description']
-        per_base_addr: int = peripheral['baseAddress']
+def register_layout(register: Register) -> tuple:
+    """Key identifying registers that map to the same type, e.g. the same register of derived peripherals."""
+    return register.name, register.size, register.fields
+
+
+def create_register_type(reg_size_b: int, reg_fields: tuple[Field, ...], structure_bitfields: bool) -> Type:
+    """Create the struct type for a single register from its SVD fields."""
+    reg_struct = StructureBuilder.create(width=reg_size_b)
+    # Bitfield members keyed by the byte offset of the union they belong to.
+    bitfield_unions: dict[int, list[StructureMember]] = {}
+    for field_name, field_lsb, field_msb in reg_fields:
+        field_msb_end = field_msb + 1
+
+        # If the field is byte aligned we can add a field to the register struct.
+        if field_is_byte_aligned(field_lsb, field_msb):
+            # Insert named struct field, field bounds are [start, end) byte offsets in the register.
+            # TODO: Check if struct field is overlapping existing struct field. (Can this even happen?)
+            field_start, field_end = field_lsb >> 3, field_msb_end >> 3
+            reg_struct.insert(field_start, uint_type(field_end - field_start), field_name)
+        elif structure_bitfields:
+            # Only structure bitfields if setting is enabled.
+            # TODO: This bugs out for n fields there will be n bytes padding at the front of the union
+            field_start, field_end = field_lsb >> 3, (field_msb + 8) >> 3
+            # The bitfield will be use the field bounds as we cannot address bits as size
+            bitfield_member = StructureMember(uint_type(field_end - field_start), field_name, field_start)
+            # Collect the bitfield, the union is created once all fields of the register are known
+            bitfield_unions.setdefault(field_start, []).append(bitfield_member)
+
+    # Insert the bitfield unions, byte aligned fields at the same offset take precedence.
+    for union_offset, bitfield_members in bitfield_unions.items():
+        reg_struct.insert(union_offset, Type.union(bitfield_members), overwrite_existing=False)
+    return Type.structure_type(reg_struct)
+
+
+def add_bitfield_comments(bv: BinaryView, reg_addr: int, reg_fields: tuple[Field, ...]):
+    for field_name, field_lsb, field_msb in reg_fields:
+        if not field_is_byte_aligned(field_lsb, field_msb):
+            bv.set_comment_at(reg_addr + (field_lsb >> 3), f'{field_name} {field_msb}:{field_lsb}')
+
+
+def add_peripheral(bv: BinaryView, peripheral: Peripheral, show_comments: bool, structure_bitfields: bool,
+                   register_types: dict[tuple, Type], peripheral_types: dict[tuple, Type]):
+    """Map a single SVD peripheral into the binary view along with its register types.
+
+    Register and peripheral types already created for an identical layout are reused from the given caches.
+    """
+    per_name = peripheral.name
+    per_base_addr = peripheral.base_address
+
+    # Get the peripheral memory range, it ends with whichever address block ends last.
+    per_size: int = max((ablk.offset + ablk.size for ablk in peripheral.address_blocks), default=0)
+
+    per_registers = peripheral.registers
+    reg_layouts = [register_layout(register) for register in per_registers]
+    per_layout = tuple((register.address_offset, reg_layout)
+                       for register, reg_layout in zip(per_registers, reg_layouts))
+    per_struct_ty = peripheral_types.get(per_layout)
+    if per_struct_ty is None:
         per_struct = StructureBuilder.create()
+        for register, reg_layout in zip(per_registers, reg_layouts):
+            reg_name = register.name
+            reg_type = register_types.get(reg_layout)
+            if reg_type is None:
+                reg_size_b = register.size >> 3
+                reg_struct_ty = create_register_type(reg_size_b, register.fields, structure_bitfields)
+                # Define the register type in the binary view.
+                reg_type_name = f'{per_name}_{reg_name}'
+                bv.define_user_type(reg_type_name, reg_struct_ty)
+                # Reference the type we just defined instead of looking it up.
+                reg_type = register_types[reg_layout] = Type.named_type_from_type(reg_type_name, reg_struct_ty)
+            # Add the register to the peripheral type
+            per_struct.insert(register.address_offset, reg_type, reg_name, overwrite_existing=False)
+        per_struct_ty = peripheral_types[per_layout] = Type.structure_type(per_struct)
 
-        per_registers = peripheral['registers']['register']
+    if show_comments:
         for register in per_registers:
-            reg_name: str = register['name']
-            reg_desc: str = register['description']
-            reg_addr_offset: int = register['addressOffset']
-            reg_size: int = register['size']
-            reg_size_b = int(reg_size / BYTE_SIZE)
-            reg_addr = per_base_addr + reg_addr_offset
-            reg_struct = StructureBuilder.create(width=reg_size_b)
-
-            reg_fields = register['fields']['field']
-            for field in reg_fields:
-                field_name: str = field['name']
-                field_lsb: int = field['lsb']
-                field_msb: int = field['msb']
-                field_lsb_b: float = field_lsb / BYTE_SIZE
-                field_msb_b: float = field_msb / BYTE_SIZE
-
-                # If the field is byte aligned we can add a field to the register struct.
-                if field_lsb_b.is_integer() and field_msb_b.is_integer():
-                    # Insert named struct field.
-                    # TODO: Check if struct field is overlapping existing struct field. (Can this even happen?)
-                    field_bounds: tuple[int, int] = (int(field_lsb_b), int(field_msb_b))
-                    reg_struct.insert(field_bounds[0], Type.int((field_bounds[1] + 1) - field_bounds[0], False),
-                                      field_name)
-                elif structure_bitfields:
-                    # Only structure bitfields if setting is enabled.
-                    # TODO: This bugs out for n fields there will be n bytes padding at the front of the union
-                    field_bounds: tuple[int, int] = (math.floor(field_lsb_b), math.ceil(field_msb_b))
-                    field_addr = reg_addr + field_bounds[0]
-                    if show_comments:
-                        bv.set_comment_at(field_addr, f'{field_name} {field_msb}:{field_lsb}')
-                    # The bitfield will be use the field bounds as we cannot address bits as size
-                    bitfield_ty = Type.int((field_bounds[1] + 1) - field_bounds[0], False)
-                    bitfield_member = StructureMember(bitfield_ty, field_name, field_bounds[0])
-                    # Create or update the bitfield union with new bitfield
-                    existing_bitfield = reg_struct.member_at_offset(field_bounds[0])
-                    if existing_bitfield is None:
-                        reg_struct.insert(field_bounds[0], Type.union([bitfield_member]), overwrite_existing=False)
-                    elif isinstance(existing_bitfield.type,
-                                    StructureType) and existing_bitfield.type.type is StructureVariant.UnionStructureType:
-                        bitfield_members = existing_bitfield.type.members
-                        bitfield_members.append(bitfield_member)
-                        reg_struct.insert(existing_bitfield.offset, Type.union(bitfield_members))
-
+            reg_addr = per_base_addr + register.address_offset
+            if structure_bitfields:
+                add_bitfield_comments(bv, reg_addr, register.fields)
             # TODO: This is displayed really poorly
-            # Add the register description as a comment
-            if show_comments:
-                bv.set_comment_at(reg_addr, reg_desc.splitlines()[0])
-            # Define the register type in the binary view.
-            reg_struct_ty = Type.structure_type(reg_struct)
-            bv.define_user_type(f'{per_name}_{reg_name}', reg_struct_ty)
-            # Add the register to the peripheral type
-            per_struct.insert(reg_addr_offset, bv.get_type_by_name(f'{per_name}_{reg_name}'), reg_name,
-                              overwrite_existing=False)
-
-        # Get the peripheral memory range
-        per_size = 0
-        per_addr_blocks = peripheral['addressBlock']
-        for addr_block in per_addr_blocks:
-            ablk_offset: int = addr_block['offset']
-            ablk_size: int = addr_block['size']
-            per_size += (ablk_offset - per_size) + ablk_size
-
-        if per_size < per_struct.width:
-            binaryninja.log_warn(f"peripheral {per_name} @ {per_base_addr} size is less than struct size... adjusting size to fit struct")
-            per_size = per_struct.width
-
-        # Add entire peripheral range
-        bv.add_user_segment(per_base_addr, per_size, 0, 0, SegmentFlag.SegmentReadable | SegmentFlag.SegmentWritable)
-        bv.add_user_section(per_name, per_base_addr, per_size, SectionSemantics.ReadWriteDataSectionSemantics)
-        bv.memory_map.add_memory_region(per_name, per_base_addr, bytearray(per_size))
-
-        # Add the peripheral description as a comment
-        if show_comments:
-            bv.set_comment_at(per_base_addr, per_desc)
-        # Define the peripheral type and data var in the binary view.
-        per_struct_ty = Type.structure_type(per_struct)
-        bv.define_user_type(per_name, per_struct_ty)
-        bv.define_user_symbol(Symbol(SymbolType.ImportedDataSymbol, per_base_addr, per_name))
-        bv.define_user_data_var(per_base_addr, bv.get_type_by_name(per_name), per_name)
+            # Add the first line of the register description as a comment
+            if register.description:
+                bv.set_comment_at(reg_addr, register.description.partition('\n')[0])
+
+    if per_size < per_struct_ty.width:
+        binaryninja.log_warn(f"peripheral {per_name} @ {per_base_addr} size is less than struct size... adjusting size to fit struct")
+        per_size = per_struct_ty.width
+
+    # Add entire peripheral range
+    bv.add_user_segment(per_base_addr, per_size, 0, 0, SegmentFlag.SegmentReadable | SegmentFlag.SegmentWritable)
+    bv.add_user_section(per_name, per_base_addr, per_size, SectionSemantics.ReadWriteDataSectionSemantics)
+    # Zeroed bytes are calloc backed, so large peripheral windows do not get their pages touched on our side.
+    bv.memory_map.add_memory_region(per_name, per_base_addr, bytes(per_size))
+
+    # Add the peripheral description as a comment
+    if show_comments and peripheral.description:
+        bv.set_comment_at(per_base_addr, peripheral.description)
+    # Define the peripheral type and data var in the binary view.
+    bv.define_user_type(per_name, per_struct_ty)
+    bv.define_user_symbol(Symbol(SymbolType.ImportedDataSymbol, per_base_addr, per_name))
+    bv.define_user_data_var(per_base_addr, Type.named_type_from_type(per_name, per_struct_ty), per_name)
+
+
+def import_svd(bv: BinaryView):
+    file_path = binaryninja.get_open_filename_input('SVD File')
+    if file_path is None: return
+    device_name, peripherals = parse_device(file_path)
+    binaryninja.log_info(f'parsing device... {device_name}')
+
+    # Read the settings once per import, they can be changed between imports.
+    import_settings = Settings()
+    show_comments = import_settings.get_bool("SVDMapper.enableComments")
+    structure_bitfields = import_settings.get_bool("SVDMapper.enableBitfieldStructuring")
+
+    # Types already created for a layout, so derived peripherals share their register types.
+    register_types: dict[tuple, Type] = {}
+    peripheral_types: dict[tuple, Type] = {}
+
+    # Group every modification into a single undo action, analysis is updated once at the end.
+    with bv.undoable_transaction():
+        for peripheral in peripherals:
+            add_peripheral(bv, peripheral, show_comments, structure_bitfields, register_types, peripheral_types)
+    bv.update_analysis()
 
 
 settings = Settings()